@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark for the /predict text normalisation. Checks that
+prepare_batch gives exactly the output of the original per-string
+preprocessing (uncompiled re.sub) on N_STRINGS synthetic bios and times both.
+
+    python benchmark_preprocessing.py [n_strings]
+"""
+
+import random
+import sys
+import time
+
+from run_hf_server import prepare_batch, preprocessing
+
+N_STRINGS = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+REGEX = "@\\S+|https?:\\S+|http?:\\S|[^A-Za-z0-9]+"
+
+words = [
+    "Dani", "Live,", "Laugh,", "Love", "Merry", "Christmas", "Everyone.",
+    "ATSU", "AuD", "'24", "She/her.", "100%", "People-Funded", "no", "lobbyist",
+    "vot.utah.gov/", "doesn't", "even", "go", "here!", "NY-14", "(BX", "&",
+    "Queens).", "Kickboxing", "World", "Champion", "--", "\t", "\n",
+]
+# rarer tokens that force the regex path: handles, urls, unicode
+special = [
+    "@elonmusk", "https://t.co/abc", "http://x.org", "htt:x", "a:b",
+    "💯%", "Café", "naïve", "İstanbul", "ß",
+]
+
+
+def make_strings(n, seed=0):
+    rng = random.Random(seed)
+    strings = []
+    for _ in range(n):
+        bio = rng.choices(words, k=rng.randint(1, 30))
+        if rng.random() < 0.2:
+            bio.insert(rng.randrange(len(bio) + 1), rng.choice(special))
+        strings.append(" ".join(bio))
+    # bytes as they arrive from flask.request.files
+    strings[::10] = [s.encode("utf-8") for s in strings[::10]]
+    return strings
+
+
+if __name__ == "__main__":
+    strings = make_strings(N_STRINGS)
+
+    start = time.perf_counter()
+    expected = [preprocessing(REGEX, string) for string in strings]
+    original = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cleaned = prepare_batch(strings)
+    batched = time.perf_counter() - start
+
+    mismatches = sum(a != b for a, b in zip(expected, cleaned))
+    print(f"{N_STRINGS} strings, {mismatches} mismatches")
+    print(f"re.sub per string: {original:.2f} s ({N_STRINGS / original:,.0f}/s)")
+    print(f"prepare_batch:     {batched:.2f} s ({N_STRINGS / batched:,.0f}/s)")
+    print(f"speedup: {original / batched:.2f}x")
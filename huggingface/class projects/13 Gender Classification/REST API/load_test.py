@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+Local load generator for run_hf_server.py. Fires N_REQUESTS /predict calls
+from CONCURRENCY threads and reports p50/p99 latency and requests/sec.
+
+Compare the micro-batched server against the one-request-at-a-time path by
+starting it with MAX_BATCH_SIZE=1, e.g.
+    MAX_BATCH_SIZE=1 python run_hf_server.py
+    MAX_BATCH_SIZE=32 MAX_WAIT_MS=5 python run_hf_server.py
+"""
+
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+URL = "http://localhost:5000/predict"
+CONCURRENCY = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+N_REQUESTS = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+texts = [
+    "graceeluke, A child of God, Crunchy Leaves",
+    "andrew_watson21, Life fast, pet dogs., ",
+    "Dani, Live, Laugh, Love, Merry Christmas Everyone.",
+    "daniellingieldjarvis, vot.utah.gov/, She doesn't even go here!",
+    """Cobratate, Light-Heavyweight Kickboxing World Champion. Escape the
+Matrix, Mastery is a funny thing. It's almost as if, on a long enough time
+scale, losing simply isn't an option. Such is the way of Wudan""",
+]
+
+
+def send(i):
+    start = time.perf_counter()
+    r = requests.post(URL, files={"text": texts[i % len(texts)]}).json()
+    assert r["success"]
+    return time.perf_counter() - start
+
+
+start = time.perf_counter()
+with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+    latencies = np.array(list(executor.map(send, range(N_REQUESTS))))
+elapsed = time.perf_counter() - start
+
+print(f"{N_REQUESTS} requests, concurrency {CONCURRENCY}")
+print(f"p50 latency: {np.percentile(latencies, 50) * 1000:.1f} ms")
+print(f"p99 latency: {np.percentile(latencies, 99) * 1000:.1f} ms")
+print(f"throughput: {N_REQUESTS / elapsed:.1f} requests/sec")
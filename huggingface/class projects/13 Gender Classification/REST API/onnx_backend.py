@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+ONNX Runtime backend for the gender classifier. The DistilBERT checkpoint is
+exported to ONNX once (optionally int8 dynamic quantised) and cached in a
+per-model directory under ONNX_DIR; later loads of the same model id reuse
+the artifact.
+
+run_hf_server.py uses this when started with BACKEND=onnx. Running this file
+exports the model, checks logits parity against PyTorch and benchmarks
+latency across sequence lengths:
+    python onnx_backend.py            # fp32
+    ONNX_QUANTIZE=1 python onnx_backend.py
+"""
+
+import os
+import re
+import time
+
+import numpy as np
+import onnxruntime as ort
+import torch
+from onnxruntime.quantization import QuantType, quantize_dynamic
+from transformers import AutoConfig, AutoModelForSequenceClassification, AutoTokenizer
+
+MODEL_ID = os.environ.get(
+    "MODEL_ID", "Saulr/distilbert-base-uncased-finetuned-gender-classification"
+)
+ONNX_DIR = os.environ.get("ONNX_DIR", "onnx_model")
+ONNX_QUANTIZE = os.environ.get("ONNX_QUANTIZE", "0") == "1"
+# intra-op threads parallelise a single matmul, inter-op threads run
+# independent graph nodes; one request at a time wants all cores intra-op
+INTRA_OP_THREADS = int(os.environ.get("INTRA_OP_THREADS", os.cpu_count()))
+INTER_OP_THREADS = int(os.environ.get("INTER_OP_THREADS", 1))
+
+
+def export_dir(model_id, onnx_dir=ONNX_DIR):
+    # one directory per model id (hub name or local path), so switching
+    # MODEL_ID never serves a graph exported from another checkpoint
+    name = re.sub(r"[^A-Za-z0-9._-]+", "--", model_id).strip("-")
+    return os.path.join(onnx_dir, name)
+
+
+def export_onnx(model_id=MODEL_ID, onnx_dir=ONNX_DIR, quantize=ONNX_QUANTIZE):
+    output_dir = export_dir(model_id, onnx_dir)
+    fp32_path = os.path.join(output_dir, "model.onnx")
+    int8_path = os.path.join(output_dir, "model.int8.onnx")
+    path = int8_path if quantize else fp32_path
+    if os.path.exists(path):
+        return path
+
+    if not os.path.exists(fp32_path):
+        os.makedirs(output_dir, exist_ok=True)
+        tokenizer = AutoTokenizer.from_pretrained(model_id)
+        model = AutoModelForSequenceClassification.from_pretrained(model_id).eval()
+        # save tokenizer and config next to the graph so serving is offline
+        tokenizer.save_pretrained(output_dir)
+        model.config.save_pretrained(output_dir)
+
+        sample = tokenizer(["rainbows and butterflies"], return_tensors="pt")
+        with torch.no_grad():
+            torch.onnx.export(
+                model,
+                (sample["input_ids"], sample["attention_mask"]),
+                fp32_path,
+                input_names=["input_ids", "attention_mask"],
+                output_names=["logits"],
+                dynamic_axes={
+                    "input_ids": {0: "batch", 1: "sequence"},
+                    "attention_mask": {0: "batch", 1: "sequence"},
+                    "logits": {0: "batch"},
+                },
+                opset_version=17,
+                dynamo=False,
+            )
+
+    if quantize:
+        quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+    return path
+
+
+class OnnxClassifier:
+    def __init__(self, path, intra_op_threads=INTRA_OP_THREADS,
+                 inter_op_threads=INTER_OP_THREADS):
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+        model_dir = os.path.dirname(path)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.id2label = AutoConfig.from_pretrained(model_dir).id2label
+
+    def run(self, input_ids, attention_mask):
+        feed = {
+            "input_ids": input_ids.astype(np.int64),
+            "attention_mask": attention_mask.astype(np.int64),
+        }
+        return self.session.run(["logits"], feed)[0]
+
+
+def load_onnx_model(model_id=MODEL_ID, onnx_dir=ONNX_DIR, quantize=ONNX_QUANTIZE):
+    return OnnxClassifier(export_onnx(model_id, onnx_dir, quantize))
+
+
+def random_texts(n_tokens, batch_size, seed=0):
+    rng = np.random.default_rng(seed)
+    words = ["rainbows", "butterflies", "christmas", "love", "dogs", "god",
+             "photography", "teaching", "kickboxing", "champion", "twitter"]
+    return [" ".join(rng.choice(words, n_tokens)) for _ in range(batch_size)]
+
+
+def parity_check(classifier, model_id=MODEL_ID, texts=None):
+    tokenizer = AutoTokenizer.from_pretrained(model_id)
+    model = AutoModelForSequenceClassification.from_pretrained(model_id).eval()
+    if texts is None:
+        # uneven lengths so padding and masking are exercised
+        texts = [" ".join(random_texts(n, 1, seed=n)) for n in (1, 5, 30, 120, 600)]
+    enc = tokenizer(texts, padding=True, truncation=True, max_length=512,
+                    return_tensors="pt")
+    with torch.no_grad():
+        expected = model(**enc).logits.numpy()
+    actual = classifier.run(enc["input_ids"].numpy(), enc["attention_mask"].numpy())
+    max_diff = np.abs(expected - actual).max()
+    same_argmax = (expected.argmax(1) == actual.argmax(1)).mean()
+    print(f"logits max abs diff: {max_diff:.2e}, argmax agreement: {same_argmax:.1%}")
+    return max_diff
+
+
+def benchmark(classifier, model_id=MODEL_ID, seq_lengths=(16, 32, 64, 128, 256, 512),
+              batch_size=1, repeats=20):
+    pt_model = AutoModelForSequenceClassification.from_pretrained(model_id).eval()
+    tokenizer = classifier.tokenizer
+
+    def timed(fn):
+        fn()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            fn()
+        return (time.perf_counter() - start) / repeats * 1000
+
+    print(f"{'seq len':>8} {'pytorch ms':>11} {'onnx ms':>9} {'speedup':>8}")
+    for seq_len in seq_lengths:
+        texts = random_texts(seq_len, batch_size)
+        enc = tokenizer(texts, truncation=True, max_length=seq_len,
+                        return_tensors="pt")
+
+        def run_pytorch():
+            with torch.no_grad():
+                pt_model(**enc)
+
+        feed = {k: enc[k].numpy().astype(np.int64)
+                for k in ("input_ids", "attention_mask")}
+        pt_ms = timed(run_pytorch)
+        ort_ms = timed(lambda: classifier.session.run(["logits"], feed))
+        print(f"{seq_len:>8} {pt_ms:>11.2f} {ort_ms:>9.2f} {pt_ms / ort_ms:>7.2f}x")
+
+
+if __name__ == "__main__":
+    classifier = load_onnx_model()
+    parity_check(classifier)
+    benchmark(classifier)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk client for /predict_batch. Streams a text file (one bio per line) to the
+server as NDJSON and writes the NDJSON predictions as they come back.
+
+    python request_batch.py bios.txt predictions.ndjson
+"""
+
+import http.client
+import json
+import socket
+import sys
+import threading
+from urllib.parse import urlsplit
+
+URL = "http://localhost:5000/predict_batch"
+# lines are sent in HTTP chunks of roughly this many bytes
+UPLOAD_CHUNK_BYTES = 64 * 1024
+
+
+def ndjson_chunks(path):
+    buffer = []
+    size = 0
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            data = (json.dumps(line.rstrip("\n")) + "\n").encode("utf-8")
+            buffer.append(data)
+            size += len(data)
+            if size >= UPLOAD_CHUNK_BYTES:
+                yield b"".join(buffer)
+                buffer, size = [], 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+def upload(sock, path, errors):
+    # chunked transfer encoding, written from its own thread: the server only
+    # buffers a couple of chunks ahead of the model, so the upload has to
+    # keep going while the main thread reads the predictions
+    try:
+        for data in ndjson_chunks(path):
+            sock.sendall(b"%x\r\n%s\r\n" % (len(data), data))
+        sock.sendall(b"0\r\n\r\n")
+    except OSError as error:
+        # the server stopped reading, e.g. it answered 503; the response
+        # says why
+        errors.append(error)
+
+
+input_path, output_path = sys.argv[1], sys.argv[2]
+
+# a plain socket rather than HTTPConnection, which drops its socket once
+# a "Connection: close" response arrives while the upload is still running
+url = urlsplit(URL)
+sock = socket.create_connection((url.hostname, url.port))
+sock.sendall(
+    f"POST {url.path} HTTP/1.1\r\n"
+    f"Host: {url.netloc}\r\n"
+    "Content-Type: application/x-ndjson\r\n"
+    "Transfer-Encoding: chunked\r\n\r\n".encode("ascii")
+)
+
+errors = []
+uploader = threading.Thread(
+    target=upload, args=(sock, input_path, errors), daemon=True
+)
+uploader.start()
+
+r = http.client.HTTPResponse(sock, method="POST")
+r.begin()
+if r.status != 200:
+    sys.exit(f"{r.status} {r.reason}: {r.read().decode('utf-8', 'replace')}")
+
+n = 0
+with open(output_path, "w") as out:
+    for line in r:
+        out.write(line.decode("utf-8"))
+        n += 1
+uploader.join()
+r.close()
+sock.close()
+if errors:
+    sys.exit(f"upload failed: {errors[0]}")
+print(f"wrote {n} predictions to {output_path}")
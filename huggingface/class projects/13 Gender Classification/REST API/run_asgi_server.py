@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+ASGI variant of run_hf_server.py. Requests are accepted on the asyncio event
+loop and inference runs on the MicroBatcher worker thread, so a slow forward
+pass never blocks the server from accepting or rejecting other requests.
+
+Run with
+    python run_asgi_server.py
+or
+    uvicorn run_asgi_server:app --host localhost --port 5000
+
+Same /predict contract as the Flask server (request.py works unchanged).
+When more than MAX_QUEUE_SIZE requests are waiting the server answers 503
+with a Retry-After header. On shutdown uvicorn stops accepting connections
+and gives in-flight requests up to DRAIN_TIMEOUT seconds to finish; the
+inference worker is stopped after that.
+POST /predict_batch takes a JSON list or an NDJSON body and streams NDJSON
+results back. Bulk chunks run on a single-thread executor, and more than
+MAX_BULK_REQUESTS concurrent bulk requests are answered with 503.
+GET /metrics reports the prediction cache counters and the padding-waste
+ratio.
+"""
+
+import asyncio
+import contextlib
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import ClientDisconnect
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+import run_hf_server as hf
+
+MAX_QUEUE_SIZE = int(os.environ.get("MAX_QUEUE_SIZE", 256))
+RETRY_AFTER = int(os.environ.get("RETRY_AFTER", 1))
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", 30))
+MAX_BULK_REQUESTS = int(os.environ.get("MAX_BULK_REQUESTS", 2))
+
+batcher = None
+bulk_executor = None
+bulk_requests = 0
+
+
+def bad_request(error):
+    return JSONResponse({"success": False, "error": error}, status_code=400)
+
+
+def overloaded():
+    return JSONResponse(
+        {"success": False, "error": "server overloaded"},
+        status_code=503,
+        headers={"Retry-After": str(RETRY_AFTER)},
+    )
+
+
+async def predict(request):
+    # read the data
+    form = await request.form()
+    text = await form["text"].read()
+
+    # preprocess the text and prepare it for classification
+    text = hf.prepare_datapoint(text)
+
+    # repeated texts are answered from the cache, the rest are handed off
+    # to the inference thread, rejecting if the queue is full
+    prediction = hf.cache.get(text)
+    if prediction is None:
+        try:
+            future = batcher.submit(text)
+        except queue.Full:
+            return overloaded()
+        prediction = await asyncio.wrap_future(future)
+        hf.cache.put(text, prediction)
+
+    return JSONResponse({"success": True, "predictions": [prediction]})
+
+
+class NDJSONResponse(StreamingResponse):
+    media_type = "application/x-ndjson"
+
+    async def __call__(self, scope, receive, send):
+        # the request body is still being read while this streams, so skip
+        # StreamingResponse's disconnect listener, which would compete for
+        # the body messages; predict_batch watches for the disconnect itself
+        await self.stream_response(send)
+
+
+async def iter_lines(request):
+    buffer = b""
+    async for data in request.stream():
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line
+    yield buffer
+
+
+async def read_ahead(request, body_read):
+    # read the body in its own task while earlier chunks are classified,
+    # buffering at most READ_AHEAD_CHUNKS chunks; clients have to read the
+    # response while they upload (see request_batch.py)
+    texts = asyncio.Queue(maxsize=hf.READ_AHEAD_CHUNKS * hf.PREDICT_CHUNK_SIZE)
+    failure = None
+
+    async def reader():
+        nonlocal failure
+        try:
+            async for line in iter_lines(request):
+                if line.strip():
+                    await texts.put(hf.parse_ndjson_line(line))
+            body_read.set()
+        except Exception as error:
+            # a broken upload, unlike a bad line, ends the stream
+            failure = error
+        await texts.put(None)
+
+    task = asyncio.create_task(reader())
+    try:
+        while True:
+            text = await texts.get()
+            # on a failure the lines still queued are dropped, so a client
+            # that disconnects mid-upload stops the work within a chunk or two
+            if text is None or failure is not None:
+                break
+            yield text
+    finally:
+        # a reader blocked on the full queue would otherwise never finish
+        task.cancel()
+    if failure is not None:
+        raise failure
+
+
+async def iter_chunks(texts, chunk_size=hf.PREDICT_CHUNK_SIZE):
+    chunk = []
+    async for text in texts:
+        chunk.append(text)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def predict_batch(request):
+    global bulk_requests
+    if bulk_requests >= MAX_BULK_REQUESTS:
+        return overloaded()
+    # the slot is held until the response has been streamed
+    bulk_requests += 1
+
+    # a JSON list is read whole, anything else is treated as an NDJSON
+    # stream and parsed while earlier chunks are being classified
+    body_read = asyncio.Event()
+    if request.headers.get("content-type", "").startswith("application/json"):
+        try:
+            items = await request.json()
+        except ValueError:
+            items = None
+        except Exception:
+            bulk_requests -= 1
+            raise
+        if not isinstance(items, list):
+            bulk_requests -= 1
+            return bad_request("expected a JSON list")
+        body_read.set()
+
+        async def iter_texts():
+            for item in items:
+                yield hf.parse_item(item)
+
+        texts = iter_texts()
+    else:
+        texts = read_ahead(request, body_read)
+
+    async def generate():
+        global bulk_requests
+        loop = asyncio.get_running_loop()
+        index = 0
+        try:
+            async for chunk in iter_chunks(texts):
+                # once the body is read receive() can only report the
+                # disconnect, so polling it no longer steals body messages;
+                # a disconnect mid-upload ends read_ahead instead
+                if body_read.is_set() and await request.is_disconnected():
+                    break
+                predictions = await loop.run_in_executor(
+                    bulk_executor, hf.predict_chunk, chunk
+                )
+                for prediction in predictions:
+                    yield hf.format_ndjson(index, prediction)
+                    index += 1
+        except ClientDisconnect:
+            pass
+        finally:
+            bulk_requests -= 1
+            await texts.aclose()
+
+    return NDJSONResponse(generate())
+
+
+async def metrics(request):
+    return JSONResponse(
+        {"cache": hf.cache.stats(), "padding": hf.padding_stats.stats()}
+    )
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global batcher, bulk_executor
+    print(("* Loading gender classificaiton model and ASGI starting server..."
+        "please wait until server has fully started"))
+    await asyncio.to_thread(hf.load_model)
+    batcher = hf.MicroBatcher(hf.classify, max_queue_size=MAX_QUEUE_SIZE)
+    bulk_executor = ThreadPoolExecutor(max_workers=1)
+    yield
+    # uvicorn has already waited for in-flight requests; anything still
+    # queued (e.g. after DRAIN_TIMEOUT) is finished before the worker stops
+    def drain():
+        batcher.close()
+        bulk_executor.shutdown(wait=True)
+
+    await asyncio.wait_for(asyncio.to_thread(drain), DRAIN_TIMEOUT)
+
+
+app = Starlette(
+    routes=[
+        Route("/predict", predict, methods=["POST"]),
+        Route("/predict_batch", predict_batch, methods=["POST"]),
+        Route("/metrics", metrics, methods=["GET"]),
+    ],
+    lifespan=lifespan,
+)
+
+if __name__ == "__main__":
+    uvicorn.run(
+        app, host="localhost", port=5000, timeout_graceful_shutdown=DRAIN_TIMEOUT
+    )
@@ -6,28 +6,375 @@ Created on Sat Dec  3 21:48:05 2022
 """
 
 import flask
+import numpy as np
+import torch
 from transformers import pipeline
-import re 
+import json
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
 
 app = flask.Flask(__name__)
 model = None
+labels = None
+batcher = None
+
+# Concurrent /predict requests are coalesced into one forward pass of up to
+# MAX_BATCH_SIZE texts, waiting at most MAX_WAIT_MS for a batch to fill.
+# MAX_BATCH_SIZE=1 gives the old one-request-at-a-time behaviour.
+MODEL_ID = os.environ.get(
+    "MODEL_ID", "Saulr/distilbert-base-uncased-finetuned-gender-classification"
+)
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 32))
+MAX_WAIT_MS = float(os.environ.get("MAX_WAIT_MS", 5))
+# "pytorch" serves the transformers pipeline, "onnx" the cached ONNX Runtime
+# export from onnx_backend.py (ONNX_QUANTIZE=1 for the int8 graph)
+BACKEND = os.environ.get("BACKEND", "pytorch")
+# predictions are cached on the cleaned text; CACHE_MAX_BYTES=0 disables it
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", 64 * 1024 ** 2))
+CACHE_TTL = float(os.environ.get("CACHE_TTL", 3600))
+# /predict_batch cleans PREDICT_CHUNK_SIZE texts at a time, sorts them by
+# length and runs them through the model PREDICT_BATCH_SIZE at a time
+PREDICT_CHUNK_SIZE = int(os.environ.get("PREDICT_CHUNK_SIZE", 4096))
+PREDICT_BATCH_SIZE = int(os.environ.get("PREDICT_BATCH_SIZE", 64))
+# at most READ_AHEAD_CHUNKS chunks of an NDJSON upload are parsed ahead of
+# the model; past that the upload is paced by inference
+READ_AHEAD_CHUNKS = int(os.environ.get("READ_AHEAD_CHUNKS", 2))
+# texts are truncated to MAX_LENGTH tokens and grouped into buckets padded
+# to a multiple of PAD_MULTIPLE, so short bios are not padded to long ones
+MAX_LENGTH = int(os.environ.get("MAX_LENGTH", 512))
+PAD_MULTIPLE = int(os.environ.get("PAD_MULTIPLE", 8))
 
 def load_model():
     # Change `transformersbook` to your Hub username
-    model_id = "Saulr/distilbert-base-uncased-finetuned-gender-classification"
-    global model
-    model = pipeline("text-classification", model=model_id)
-    
-def prepare_datapoint(string):
+    global model, labels
+    if BACKEND == "onnx":
+        from onnx_backend import load_onnx_model
+        model = load_onnx_model(MODEL_ID)
+        labels = response_labels(model.id2label)
+    else:
+        model = pipeline("text-classification", model=MODEL_ID)
+        labels = response_labels(model.model.config.id2label)
+
+def response_labels(id2label):
+    # response key for each class id, taken from the model config; configs
+    # with generic LABEL_0/LABEL_1 names keep the original order, class id 0
+    # is Male and 1 is Female
+    names = {i: str(label).capitalize() for i, label in id2label.items()}
+    if sorted(names.values()) == ["Female", "Male"]:
+        return names
+    return {0: "Male", 1: "Female"}
+
+text_cleaning_re = re.compile(r"@\S+|https?:\S+|http?:\S|[^A-Za-z0-9]+")
+# ASCII fast path: lowercase and map every byte outside [a-z0-9] to a space
+ascii_cleaning_table = bytes(
+    c + 32 if 65 <= c <= 90 else c if 48 <= c <= 57 or 97 <= c <= 122 else 32
+    for c in range(256)
+)
+
+def normalise(string):
     string = str(string)
-    text_cleaning_re = "@\S+|https?:\S+|http?:\S|[^A-Za-z0-9]+"
-    string = preprocessing(text_cleaning_re, string)
-    return string
+    # without "@" or ":" neither the handle nor the url alternatives can
+    # match, so for ASCII text the regex only collapses non-alphanumeric
+    # runs, which translate + split/join does exactly
+    if string.isascii() and "@" not in string and ":" not in string:
+        return b" ".join(
+            string.encode("ascii").translate(ascii_cleaning_table).split()
+        ).decode("ascii")
+    return text_cleaning_re.sub(" ", string.lower()).strip()
+
+def prepare_batch(strings):
+    return [normalise(string) for string in strings]
+
+def prepare_datapoint(string):
+    return normalise(string)
 
 def preprocessing(regex, text):
   text = re.sub(regex, ' ', str(text).lower()).strip()
   return text
-    
+
+class PaddingStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.real_tokens = 0
+        self.padded_tokens = 0
+        self.batches = 0
+
+    def update(self, attention_mask):
+        with self.lock:
+            self.real_tokens += int(attention_mask.sum())
+            self.padded_tokens += attention_mask.size
+            self.batches += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "batches": self.batches,
+                "real_tokens": self.real_tokens,
+                "padded_tokens": self.padded_tokens,
+                # fraction of the tokens fed to the model that are padding
+                "waste_ratio": 1 - self.real_tokens / self.padded_tokens
+                if self.padded_tokens else 0.0,
+            }
+
+padding_stats = PaddingStats()
+
+def bucket_batches(tokenizer, texts, max_length=MAX_LENGTH,
+                   pad_multiple=PAD_MULTIPLE):
+    input_ids = tokenizer(texts, truncation=True, max_length=max_length)["input_ids"]
+    buckets = {}
+    for i, ids in enumerate(input_ids):
+        # round up to the bucket size, but never pad past max_length
+        length = min(-(-len(ids) // pad_multiple) * pad_multiple, max_length)
+        buckets.setdefault(length, []).append(i)
+    for length, indices in sorted(buckets.items()):
+        batch = tokenizer.pad(
+            {"input_ids": [input_ids[i] for i in indices]},
+            padding="max_length", max_length=length, return_tensors="np",
+        )
+        yield indices, batch["input_ids"], batch["attention_mask"]
+
+# one forward pass at a time: the micro-batcher and /predict_batch share the
+# model, and concurrent passes would only compete for the same cores
+inference_lock = threading.Lock()
+
+def run_logits(input_ids, attention_mask):
+    with inference_lock:
+        if BACKEND == "onnx":
+            return model.run(input_ids, attention_mask)
+        with torch.inference_mode():
+            return model.model(
+                input_ids=torch.from_numpy(input_ids),
+                attention_mask=torch.from_numpy(attention_mask),
+            ).logits.float().numpy()
+
+def format_prediction(logits):
+    probs = np.exp(logits - logits.max())
+    probs /= probs.sum()
+    return {labels[i]: float(p) for i, p in enumerate(probs)}
+
+def classify(texts):
+    # one forward pass per length bucket instead of padding every text to
+    # the longest one
+    results = [None] * len(texts)
+    for indices, input_ids, attention_mask in bucket_batches(model.tokenizer, texts):
+        padding_stats.update(attention_mask)
+        for i, logits in zip(indices, run_logits(input_ids, attention_mask)):
+            results[i] = format_prediction(logits)
+    return results
+
+def predict_chunk(items, batch_size=PREDICT_BATCH_SIZE):
+    # items that failed to parse are ValueErrors and answered in place
+    results = [
+        {"error": str(item)} if isinstance(item, ValueError) else None
+        for item in items
+    ]
+    cleaned = {i: normalise(items[i]) for i, result in enumerate(results)
+               if result is None}
+    # similar lengths share a batch so little compute is spent on padding
+    order = sorted(cleaned, key=lambda i: len(cleaned[i]))
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        for i, prediction in zip(batch, classify([cleaned[i] for i in batch])):
+            results[i] = prediction
+    return results
+
+def parse_item(item):
+    # batch items are JSON strings or objects with a "text" field; anything
+    # else becomes a ValueError that is reported on its own output line
+    if isinstance(item, dict):
+        item = item.get("text")
+    if not isinstance(item, str):
+        return ValueError('expected a string or an object with a "text" string')
+    return item
+
+def parse_ndjson_line(line):
+    try:
+        item = json.loads(line)
+    except ValueError as error:
+        return ValueError(f"invalid JSON: {error}")
+    return parse_item(item)
+
+def read_ahead(lines, max_buffered=READ_AHEAD_CHUNKS * PREDICT_CHUNK_SIZE):
+    # the request body is read on its own thread while earlier chunks are
+    # classified, buffering at most max_buffered lines; a client must read
+    # the response while it uploads (as request_batch.py does), or both
+    # sides block once the socket buffers fill up
+    texts = queue.Queue(maxsize=max_buffered)
+    failure = []
+    stopped = threading.Event()
+    def put(item):
+        # gives up once the response has been closed, e.g. on disconnect
+        while not stopped.is_set():
+            try:
+                texts.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def reader():
+        try:
+            for line in lines:
+                if line.strip() and not put(parse_ndjson_line(line)):
+                    return
+        except Exception as error:
+            # a broken upload, unlike a bad line, ends the stream
+            failure.append(error)
+        put(None)
+    threading.Thread(target=reader, daemon=True).start()
+    try:
+        while True:
+            text = texts.get()
+            # on a failure the lines still queued are dropped
+            if failure:
+                raise failure[0]
+            if text is None:
+                return
+            yield text
+    finally:
+        stopped.set()
+
+def iter_chunks(texts, chunk_size=PREDICT_CHUNK_SIZE):
+    chunk = []
+    for text in texts:
+        chunk.append(text)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def format_ndjson(index, prediction):
+    return json.dumps({"index": index, **prediction}) + "\n"
+
+class MicroBatcher:
+    def __init__(self, predict_fn, max_batch_size=MAX_BATCH_SIZE,
+                 max_wait_ms=MAX_WAIT_MS, max_queue_size=0):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        # max_queue_size=0 is unbounded, otherwise submit raises queue.Full
+        self.requests = queue.Queue(maxsize=max_queue_size)
+        self.closing = False
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, text):
+        future = Future()
+        self.requests.put_nowait((text, future))
+        return future
+
+    def pending(self):
+        return self.requests.qsize()
+
+    def close(self):
+        # requests queued before the sentinel are still answered
+        self.requests.put(None)
+        self.worker.join()
+
+    def next_batch(self):
+        batch = []
+        item = self.requests.get()
+        deadline = time.monotonic() + self.max_wait
+        while item is not None:
+            batch.append(item)
+            if len(batch) >= self.max_batch_size:
+                return batch
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                return batch
+            try:
+                item = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                return batch
+        self.closing = True
+        return batch
+
+    def run(self):
+        while not self.closing:
+            batch = self.next_batch()
+            if not batch:
+                continue
+            try:
+                results = self.predict_fn([text for text, _ in batch])
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+class PredictionCache:
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def entry_size(key, value):
+        return sys.getsizeof(key) + sys.getsizeof(value) + 2 * sys.getsizeof(0.0)
+
+    def remove(self, key):
+        _, _, size = self.entries.pop(key)
+        self.bytes -= size
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires, _ = entry
+            if time.monotonic() > expires:
+                self.remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            # most recently used entries live at the end
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.entry_size(key, value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (value, time.monotonic() + self.ttl, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+cache = PredictionCache()
+
 @app.route("/predict", methods = ["POST"])
 def predict():
     # initialize the data dictionary that will be returned from the
@@ -43,19 +390,18 @@ def predict():
         # preprocess the image and prepare it for classification
         text = prepare_datapoint(text)
 
-        # classify the input image and then initialize the list
-        # of predictions to return to the client
-        preds = model(text, return_all_scores = True)
-
-        data["predictions"] = []
+        # repeated texts are answered from the cache, the rest go through
+        # the micro-batcher, which waits for other requests to share the
+        # forward pass
+        prediction = cache.get(text)
+        if prediction is None:
+            if batcher is not None:
+                prediction = batcher.submit(text).result()
+            else:
+                prediction = classify([text])[0]
+            cache.put(text, prediction)
 
-        # loop over the results and add them to the list of
-        # returned predictions
-        for instance in preds:
-            p = {"Male": float(instance[0]["score"]),
-                 "Female": float(instance[1]["score"])
-                 }
-            data["predictions"].append(p)
+        data["predictions"] = [prediction]
 
         # indicate that the request was a success
         data["success"] = True
@@ -63,11 +409,39 @@ def predict():
     # return the data dictionary as a JSON response
     return flask.jsonify(data)
 
+@app.route("/predict_batch", methods = ["POST"])
+def predict_batch():
+    # a JSON list is read whole, anything else is treated as an NDJSON
+    # stream and read line by line while results are being sent back
+    if flask.request.is_json:
+        items = flask.request.get_json(silent=True)
+        if not isinstance(items, list):
+            return flask.jsonify({"success": False,
+                                  "error": "expected a JSON list"}), 400
+        texts = [parse_item(item) for item in items]
+    else:
+        texts = read_ahead(flask.request.stream)
+
+    def generate():
+        index = 0
+        for chunk in iter_chunks(texts):
+            for prediction in predict_chunk(chunk):
+                yield format_ndjson(index, prediction)
+                index += 1
+
+    return flask.Response(flask.stream_with_context(generate()),
+                          mimetype="application/x-ndjson")
+
+@app.route("/metrics", methods = ["GET"])
+def metrics():
+    return flask.jsonify({"cache": cache.stats(), "padding": padding_stats.stats()})
+
 # if this is the main thread of execution first load the model and
 # then start the server
 if __name__ == "__main__":
     print(("* Loading gender classificaiton model and Flask starting server..."
         "please wait until server has fully started"))
     load_model()
-    app.run(host='localhost', port=5000)
-    
+    batcher = MicroBatcher(classify)
+    app.run(host='localhost', port=5000, threaded=True)
+
@@ -1,18 +1,118 @@
+import io
+import json
+import math
+import os
+import queue
+import random
+import resource
+import sqlite3
+import threading
+import time
+import numpy as np
+import pandas as pd
 import torch
 import torch.nn as nn
 import torch.nn.init as init
 import torch.nn.functional as F
 import torch.optim as optim
+import torch.multiprocessing as mp
 
+from collections import defaultdict
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
+from contextlib import contextmanager
 from copy import deepcopy
 from tqdm import tqdm
+from torch.ao.quantization import (
+    DeQuantStub,
+    QuantStub,
+    convert,
+    get_default_qconfig,
+    prepare,
+    quantize_dynamic,
+)
+from torch.func import functional_call, stack_module_state, vmap
 from torch.optim.lr_scheduler import CosineAnnealingLR
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import (
+    Dataset,
+    DataLoader,
+    IterableDataset,
+    get_worker_info,
+)
+from torch.utils.data._utils.collate import default_collate_fn_map
+
+
+class MixedFeatures:
+    # Dense float columns plus categorical index columns (int32), batched and
+    # moved together so the loaders treat it like a single tensor.
+    def __init__(self, dense, categorical):
+        self.dense = dense
+        self.categorical = categorical
+
+    @property
+    def device(self):
+        return self.dense.device
+
+    @property
+    def is_cuda(self):
+        return self.dense.is_cuda
+
+    def __len__(self):
+        return len(self.dense)
+
+    def __getitem__(self, index):
+        return MixedFeatures(self.dense[index], self.categorical[index])
+
+    def index_select(self, dim, index):
+        return MixedFeatures(
+            self.dense.index_select(dim, index),
+            self.categorical.index_select(dim, index),
+        )
+
+    def to(self, device, non_blocking=False):
+        return MixedFeatures(
+            self.dense.to(device, non_blocking=non_blocking),
+            self.categorical.to(device, non_blocking=non_blocking),
+        )
+
+    def pin_memory(self):
+        return MixedFeatures(self.dense.pin_memory(), self.categorical.pin_memory())
+
+    def is_pinned(self):
+        return self.dense.is_pinned() and self.categorical.is_pinned()
+
+    def record_stream(self, stream):
+        self.dense.record_stream(stream)
+        self.categorical.record_stream(stream)
+
+
+def collate_mixed_features(batch, *, collate_fn_map=None):
+    return MixedFeatures(
+        torch.stack([sample.dense for sample in batch]),
+        torch.stack([sample.categorical for sample in batch]),
+    )
+
+
+# lets DataLoader's default_collate batch CustomDataset(x, y, x_categorical)
+default_collate_fn_map[MixedFeatures] = collate_mixed_features
 
 
 class NeuralNetwork(nn.Module):
-    def __init__(self, input_size, hidden_size, dropout=0.2):
+    def __init__(
+        self,
+        input_size,
+        hidden_size,
+        dropout=0.2,
+        fused=False,
+        categorical_cardinalities=None,
+        sparse_embeddings=True,
+    ):
         super(NeuralNetwork, self).__init__()
+        self.fused = fused
+        self.folded_cache = None
         self.fc1 = nn.Linear(input_size, hidden_size)
         self.dropout1 = nn.Dropout(dropout)
         self.bn1 = nn.BatchNorm1d(hidden_size)
@@ -36,18 +136,210 @@ class NeuralNetwork(nn.Module):
         init.zeros_(self.fc3.bias)
         init.zeros_(self.fc4.bias)
 
+        # Categorical columns: summing one embedding row per column is exactly
+        # fc1 applied to their one-hot encoding, without materialising it.
+        # input_size then counts the dense columns only.
+        self.embedding = None
+        if categorical_cardinalities:
+            self.embedding = nn.EmbeddingBag(
+                sum(categorical_cardinalities),
+                hidden_size,
+                mode="sum",
+                sparse=sparse_embeddings,
+            )
+            init.kaiming_uniform_(self.embedding.weight.T)
+            offsets = torch.tensor([0] + list(categorical_cardinalities[:-1]))
+            self.register_buffer("category_offsets", offsets.cumsum(0).to(torch.int32))
+
+    def input_layer(self, x):
+        if isinstance(x, MixedFeatures):
+            indices = x.categorical + self.category_offsets
+            return self.fc1(x.dense) + self.embedding(indices)
+        return self.fc1(x)
+
     def forward(self, x):
+        if self.fused and not self.training and not isinstance(x, MixedFeatures):
+            return self.fused_forward(x)
         # linear -> relu -> dropout -> batchnorm
-        x = self.bn1(self.dropout1(F.relu(self.fc1(x))))
+        x = self.bn1(self.dropout1(F.relu(self.input_layer(x))))
         x = self.bn2(self.dropout2(F.relu(self.fc2(x))))
         x = self.bn3(self.dropout3(F.relu(self.fc3(x))))
         x = self.fc4(x)  # Output layer
         return x
 
+    def fused_forward(self, x):
+        # Inference only: in eval mode each bn is a fixed affine map, so it is
+        # folded into the following fc and a block becomes addmm + relu.
+        # Training always takes the eager path above; a custom autograd
+        # Function for fc -> relu -> dropout measured no faster than eager.
+        layers = self.folded_layers()
+        for weight, bias in layers[:-1]:
+            x = torch.addmm(bias, x, weight.t()).relu_()
+        weight, bias = layers[-1]
+        return torch.addmm(bias, x, weight.t())
+
+    def folded_layers(self):
+        # cached until a parameter or bn statistic changes: in-place updates
+        # (optimizer steps, load_state_dict) bump _version and .to() swaps
+        # the storage. Not cached while autograd records, so input gradients
+        # through the folded weights still work.
+        modules = (self.fc1, self.bn1, self.fc2, self.bn2, self.fc3, self.bn3)
+        tensors = [self.fc4.weight, self.fc4.bias]
+        for module in modules:
+            tensors += [module.weight, module.bias]
+            if isinstance(module, nn.BatchNorm1d):
+                tensors += [module.running_mean, module.running_var]
+        key = tuple((t.data_ptr(), t._version) for t in tensors)
+        if self.folded_cache is not None and self.folded_cache[0] == key:
+            return self.folded_cache[1]
+
+        layers = []
+        weight, bias = self.fc1.weight, self.fc1.bias
+        blocks = ((self.bn1, self.fc2), (self.bn2, self.fc3), (self.bn3, self.fc4))
+        for bn, next_fc in blocks:
+            layers.append((weight, bias))
+            scale = bn.weight * torch.rsqrt(bn.running_var + bn.eps)
+            shift = bn.bias - bn.running_mean * scale
+            weight = next_fc.weight * scale
+            bias = torch.addmv(next_fc.bias, next_fc.weight, shift)
+        layers.append((weight, bias))
+        if not torch.is_grad_enabled():
+            self.folded_cache = (key, layers)
+        return layers
+
+
+class NeuralNetworkEnsemble(nn.Module):
+    # n_members NeuralNetworks (one seed each) whose parameters and buffers
+    # are stacked along a leading member dimension; forward runs all members
+    # in one vmap'd call and returns (n_members, batch, 1). Because the
+    # stacked tensors are ordinary parameters, a single Adam over
+    # ensemble.parameters() is exactly one Adam per member.
+    def __init__(self, input_size, hidden_size, n_members=10, dropout=0.2, seed=0):
+        super(NeuralNetworkEnsemble, self).__init__()
+        members = []
+        for member in range(n_members):
+            torch.manual_seed(seed + member)
+            members.append(NeuralNetwork(input_size, hidden_size, dropout=dropout))
+        params, buffers = stack_module_state(members)
+
+        self.n_members = n_members
+        self.names = list(params) + list(buffers)
+        for name, tensor in params.items():
+            self.register_parameter(
+                name.replace(".", "__"), nn.Parameter(tensor.detach())
+            )
+        for name, tensor in buffers.items():
+            self.register_buffer(name.replace(".", "__"), tensor)
+        # stateless template for functional_call, kept out of the module tree
+        self.__dict__["template"] = deepcopy(members[0]).to("meta")
+
+    def train(self, mode=True):
+        super(NeuralNetworkEnsemble, self).train(mode)
+        self.template.train(mode)
+        return self
+
+    def forward(self, x):
+        state = {name: getattr(self, name.replace(".", "__")) for name in self.names}
+
+        def member_forward(state, x):
+            return functional_call(self.template, state, (x,))
+
+        return vmap(member_forward, in_dims=(0, None), randomness="different")(state, x)
+
+
+class EnsembleEarlyStopper:
+    # EarlyStopper with one best loss, patience counter and best snapshot per
+    # member; early_stop returns True once every member has run out of
+    # patience.
+    def __init__(self, n_members, patience=1, min_delta=0.0):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.counter = torch.zeros(n_members, dtype=torch.long)
+        self.best_loss = torch.full((n_members,), float("inf"))
+        self.best_model_weights = None
+
+    def early_stop(self, losses, model):
+        losses = torch.as_tensor(losses, dtype=torch.float32)
+        improved = losses < self.best_loss - self.min_delta
+        self.best_loss = torch.where(improved, losses, self.best_loss)
+        self.counter = torch.where(improved, 0, self.counter + 1)
+
+        state_dict = model.state_dict()
+        if self.best_model_weights is None:
+            self.best_model_weights = {
+                name: tensor.detach().clone() for name, tensor in state_dict.items()
+            }
+        elif improved.any():
+            with torch.no_grad():
+                for name, tensor in state_dict.items():
+                    mask = improved.to(tensor.device)
+                    self.best_model_weights[name][mask] = tensor[mask]
+        return bool((self.counter >= self.patience).all())
+
+    def restore_best_weights(self, model):
+        with torch.no_grad():
+            for name, tensor in model.state_dict().items():
+                tensor.copy_(self.best_model_weights[name])
+
+
+def fit_ensemble(
+    ensemble,
+    train_loader,
+    val_loader,
+    optimizer,
+    criterion,
+    device,
+    n_epochs,
+    early_stopper=None,
+):
+    # criterion must return a scalar per call (e.g. nn.MSELoss()); it is
+    # vmap'd to give one loss per member. Returns per-epoch member losses.
+    ensemble.to(device)
+    member_criterion = vmap(criterion, in_dims=(0, None))
+    history = {"train_loss": [], "val_loss": []}
+
+    for epoch in range(n_epochs):
+        set_loader_epoch(train_loader, epoch)
+        ensemble.train()
+        train_loss = torch.zeros(ensemble.n_members, device=device)
+        n_batches = 0
+        for x, y in train_loader:
+            x, y = x.to(device), y.to(device)
+            optimizer.zero_grad()
+            losses = member_criterion(ensemble(x), y)
+            # members share no parameters, so the sum keeps gradients separate
+            losses.sum().backward()
+            optimizer.step()
+            train_loss += losses.detach()
+            n_batches += 1
+        history["train_loss"].append((train_loss / n_batches).cpu())
+
+        ensemble.eval()
+        val_loss = torch.zeros(ensemble.n_members, device=device)
+        n_batches = 0
+        with torch.no_grad():
+            for x, y in val_loader:
+                x, y = x.to(device), y.to(device)
+                val_loss += member_criterion(ensemble(x), y)
+                n_batches += 1
+        history["val_loss"].append((val_loss / n_batches).cpu())
+
+        if early_stopper is not None and early_stopper.early_stop(
+            history["val_loss"][-1], ensemble
+        ):
+            break
+
+    if early_stopper is not None:
+        early_stopper.restore_best_weights(ensemble)
+    return history
+
 
 class ConvolutionalNeuralNetwork(nn.Module):
-    def __init__(self, input_size=1, n_classes=10, hidden_size=[50]):
+    def __init__(
+        self, input_size=1, n_classes=10, hidden_size=[50], channels_last=False
+    ):
         super(ConvolutionalNeuralNetwork, self).__init__()
+        self.channels_last = channels_last
         self.conv1 = nn.Conv2d(
             in_channels=input_size, out_channels=10, kernel_size=5, stride=1, padding=0
         )
@@ -62,10 +354,16 @@ class ConvolutionalNeuralNetwork(nn.Module):
         self.fc2 = nn.Linear(hidden_size[0], n_classes)
         nn.init.xavier_uniform_(self.fc2.weight)
 
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
+
     def forward(self, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
         x = F.relu(F.max_pool2d(self.conv1(x), 2))
         x = F.relu(F.max_pool2d(self.conv2_dropout(self.conv2(x)), 2))
-        x = x.view(-1, 320)
+        # reshape rather than view: channels_last activations are not contiguous
+        x = x.reshape(-1, 320)
         x = F.relu(self.fc1(x))
         x = F.dropout(x, training=self.training)
         x = self.fc2(x)
@@ -73,15 +371,29 @@ class ConvolutionalNeuralNetwork(nn.Module):
 
 
 class EarlyStopper:
+    # snapshot="deepcopy" copies the state_dict on every improvement,
+    # "inplace" copies into shadow buffers allocated once, and "mmap" backs
+    # those shadow buffers with a memory-mapped file at mmap_path.
     def __init__(
-        self, patience: int = 1, min_delta: float = 0.0, verbose: bool = False
+        self,
+        patience: int = 1,
+        min_delta: float = 0.0,
+        verbose: bool = False,
+        snapshot: str = "deepcopy",
+        mmap_path: str = None,
     ):
+        if snapshot not in ("deepcopy", "inplace", "mmap"):
+            raise ValueError(f"Unknown snapshot mode: {snapshot}")
+        if snapshot == "mmap" and mmap_path is None:
+            raise ValueError("snapshot='mmap' requires mmap_path")
         self.patience = patience
         self.min_delta = min_delta
         self.counter = 0
         self.best_loss = float("inf")
         self.best_model_weights = None
         self.verbose = verbose
+        self.snapshot = snapshot
+        self.mmap_path = mmap_path
 
     def early_stop(self, loss:float, model:nn.Module):
         if loss < self.best_loss - self.min_delta:
@@ -97,14 +409,54 @@ class EarlyStopper:
         return False
 
     def save_best_weights(self, model):
-        self.best_model_weights = deepcopy(model.state_dict())
+        if self.snapshot == "deepcopy":
+            self.best_model_weights = deepcopy(model.state_dict())
+            return
+
+        state_dict = model.state_dict()
+        if self.best_model_weights is None:
+            self.best_model_weights = self.allocate_snapshot(state_dict)
+        with torch.no_grad():
+            for name, tensor in state_dict.items():
+                self.best_model_weights[name].copy_(tensor)
+
+    def allocate_snapshot(self, state_dict):
+        if self.snapshot == "inplace":
+            return {name: torch.empty_like(t) for name, t in state_dict.items()}
+
+        # one file for all tensors, each slot aligned to 64 bytes
+        offsets = {}
+        n_bytes = 0
+        for name, tensor in state_dict.items():
+            offsets[name] = n_bytes
+            n_bytes += -(-tensor.numel() * tensor.element_size() // 64) * 64
+        buffer = torch.from_file(
+            self.mmap_path, shared=True, size=n_bytes, dtype=torch.uint8
+        )
+        snapshot = {}
+        for name, tensor in state_dict.items():
+            start = offsets[name]
+            stop = start + tensor.numel() * tensor.element_size()
+            snapshot[name] = buffer[start:stop].view(tensor.dtype).view(tensor.shape)
+        return snapshot
 
     def restore_best_weights(self, model):
-        model.load_state_dict(self.best_model_weights)
+        if self.snapshot == "deepcopy":
+            model.load_state_dict(self.best_model_weights)
+            return
+
+        with torch.no_grad():
+            for name, tensor in model.state_dict().items():
+                tensor.copy_(self.best_model_weights[name])
 
 
 class CustomDataset(Dataset):
-    def __init__(self, x, y):
+    def __init__(self, x, y, x_categorical=None):
+        if x_categorical is not None:
+            x_categorical = torch.as_tensor(
+                x_categorical, dtype=torch.int32, device=x.device
+            )
+            x = MixedFeatures(x, x_categorical)
         self.x = x
         self.y = y
 
@@ -115,43 +467,1109 @@ class CustomDataset(Dataset):
         return len(self.x)
 
 
-def train_regression(model, data_loader, optimizer, criterion, device):
-    model.to(device).train()
-    batch_loss = []
+class StreamingTableDataset(IterableDataset):
+    # Reads a Parquet/CSV file (or a memory-mapped .npy matrix) in chunks of
+    # chunk_size rows and yields ready-made (x, y) batches, so memory stays
+    # bounded by chunk_size + shuffle_buffer rows regardless of table size.
+    # For .npy inputs the columns are integer indices. Use it directly as the
+    # data_loader, or wrap it in DataLoader(dataset, batch_size=None). With
+    # num_workers > 0 each worker reads only its own Parquet row groups, CSV
+    # byte range or .npy row ranges; call set_epoch(epoch) before every epoch
+    # (fit_* does) so the shuffle changes, since workers get a fresh copy.
+    def __init__(
+        self,
+        path,
+        target_columns,
+        feature_columns=None,
+        batch_size=64,
+        chunk_size=65536,
+        shuffle_buffer=0,
+        target_dtype=torch.float32,
+        seed=0,
+        verbose=False,
+    ):
+        super(StreamingTableDataset, self).__init__()
+        self.path = str(path)
+        self.target_columns = target_columns
+        self.feature_columns = feature_columns
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.shuffle_buffer = shuffle_buffer
+        self.target_dtype = target_dtype
+        self.seed = seed
+        self.epoch = 0
+        self.verbose = verbose
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def iter_frames(self, worker_id=0, num_workers=1):
+        columns = None
+        if self.feature_columns is not None:
+            targets = self.target_columns
+            columns = list(self.feature_columns) + (
+                [targets] if isinstance(targets, str) else list(targets)
+            )
+
+        if self.path.endswith(".parquet"):
+            import pyarrow.parquet as pq
+
+            parquet_file = pq.ParquetFile(self.path)
+            row_groups = list(
+                range(worker_id, parquet_file.num_row_groups, num_workers)
+            )
+            if not row_groups:
+                return
+            for batch in parquet_file.iter_batches(
+                batch_size=self.chunk_size, row_groups=row_groups, columns=columns
+            ):
+                yield batch.to_pandas()
+        elif self.path.endswith(".csv"):
+            names = pd.read_csv(self.path, nrows=0).columns
+            begin, end = csv_byte_range(self.path, worker_id, num_workers)
+            if begin >= end:
+                return
+            with open(self.path, "rb") as f:
+                f.seek(begin)
+                shard = io.BufferedReader(ByteRangeReader(f, end - begin))
+                yield from pd.read_csv(
+                    shard,
+                    header=None,
+                    names=names,
+                    chunksize=self.chunk_size,
+                    usecols=columns,
+                )
+        elif self.path.endswith(".npy"):
+            array = np.load(self.path, mmap_mode="r")
+            step = self.chunk_size * num_workers
+            for start in range(worker_id * self.chunk_size, len(array), step):
+                yield array[start : start + self.chunk_size]
+        else:
+            raise ValueError(f"Unsupported file type: {self.path}")
+
+    def split_chunk(self, chunk):
+        targets = self.target_columns
+        if isinstance(chunk, np.ndarray):
+            features = self.feature_columns
+            if features is None:
+                target_list = [targets] if isinstance(targets, int) else targets
+                features = [i for i in range(chunk.shape[1]) if i not in target_list]
+            return chunk[:, features], chunk[:, targets]
+
+        features = self.feature_columns
+        if features is None:
+            features = chunk.columns.drop(targets)
+        return chunk[features].to_numpy(), chunk[targets].to_numpy()
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+        generator = np.random.default_rng([self.seed, self.epoch, worker_id])
+        if worker_info is None:
+            # in-process iteration keeps reshuffling without set_epoch
+            self.epoch += 1
+
+        x_buffer, y_buffer = [], []
+        buffered_rows = 0
+        start = time.perf_counter()
+        for chunk_index, chunk in enumerate(self.iter_frames(worker_id, num_workers)):
+            x_chunk, y_chunk = self.split_chunk(chunk)
+            x_buffer.append(np.asarray(x_chunk, dtype=np.float32))
+            y_buffer.append(np.asarray(y_chunk))
+            buffered_rows += len(x_chunk)
+
+            n_yielded = 0
+            if buffered_rows >= max(self.shuffle_buffer, self.batch_size):
+                x_buffer, y_buffer, batches = self.drain(
+                    x_buffer, y_buffer, generator, keep_remainder=True
+                )
+                for batch in batches:
+                    n_yielded += len(batch[0])
+                    yield batch
+                buffered_rows = len(x_buffer[0])
+
+            # elapsed covers reading the chunk and consuming its batches
+            if self.verbose:
+                elapsed = time.perf_counter() - start
+                print(
+                    f"Chunk {chunk_index}: {len(x_chunk)} rows read, "
+                    f"{n_yielded} rows yielded, {len(x_chunk) / elapsed:.0f} rows/sec"
+                )
+            start = time.perf_counter()
+
+        if buffered_rows:
+            _, _, batches = self.drain(
+                x_buffer, y_buffer, generator, keep_remainder=False
+            )
+            yield from batches
+
+    def drain(self, x_buffer, y_buffer, generator, keep_remainder):
+        x = np.concatenate(x_buffer)
+        y = np.concatenate(y_buffer)
+        if self.shuffle_buffer:
+            permutation = generator.permutation(len(x))
+            x, y = x[permutation], y[permutation]
+
+        n_rows = len(x)
+        if keep_remainder:
+            n_rows -= n_rows % self.batch_size
+        batches = [
+            (
+                torch.from_numpy(x[start : start + self.batch_size]),
+                torch.as_tensor(
+                    y[start : start + self.batch_size], dtype=self.target_dtype
+                ),
+            )
+            for start in range(0, n_rows, self.batch_size)
+        ]
+        return [x[n_rows:]], [y[n_rows:]], batches
+
+
+class ByteRangeReader(io.RawIOBase):
+    # Raw reader over the next `length` bytes of an open binary file, so
+    # pd.read_csv parses only one worker's slice of a CSV.
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.file.read(min(len(buffer), self.remaining))
+        buffer[: len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+
+def csv_byte_range(path, worker_id, num_workers):
+    # Splits the data rows of a CSV into num_workers byte ranges aligned to
+    # line starts (quoted fields must not contain newlines).
+    with open(path, "rb") as f:
+        f.readline()
+        data_start = f.tell()
+        size = os.fstat(f.fileno()).st_size
+
+        def line_start(offset):
+            if offset <= data_start or offset >= size:
+                return min(max(offset, data_start), size)
+            f.seek(offset - 1)
+            f.readline()
+            return f.tell()
+
+        span = size - data_start
+        return (
+            line_start(data_start + span * worker_id // num_workers),
+            line_start(data_start + span * (worker_id + 1) // num_workers),
+        )
+
+
+def set_loader_epoch(data_loader, epoch):
+    # Reseeds per-epoch shuffling for loaders/datasets that support it
+    # (StreamingTableDataset, directly or inside a DataLoader).
+    for source in (data_loader, getattr(data_loader, "dataset", None)):
+        if hasattr(source, "set_epoch"):
+            source.set_epoch(epoch)
+            return
+
+
+class TensorBatchLoader:
+    # Drop-in for DataLoader over tensors that already live on `device`:
+    # one permutation per epoch, then whole batches are sliced out directly
+    # instead of being collated sample by sample.
+    def __init__(self, *tensors, batch_size=64, shuffle=False, drop_last=False):
+        if len(tensors) == 1 and isinstance(tensors[0], CustomDataset):
+            tensors = (tensors[0].x, tensors[0].y)
+        if any(len(t) != len(tensors[0]) for t in tensors):
+            raise ValueError("All tensors must have the same first dimension")
+        self.tensors = tensors
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        tensors = self.tensors
+        n_samples = len(tensors[0])
+        if self.shuffle:
+            permutation = torch.randperm(n_samples, device=tensors[0].device)
+            tensors = tuple(t.index_select(0, permutation) for t in tensors)
+
+        stop = n_samples - n_samples % self.batch_size if self.drop_last else n_samples
+        for start in range(0, stop, self.batch_size):
+            batch = tuple(t[start : start + self.batch_size] for t in tensors)
+            yield batch if len(batch) > 1 else batch[0]
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.tensors[0]) // self.batch_size
+        return -(-len(self.tensors[0]) // self.batch_size)
+
+
+class DevicePrefetcher:
+    # Wraps any loader and stages batch N+1 on `device` while batch N is being
+    # used. On CUDA the copy comes from pinned memory with non_blocking=True on
+    # a side stream; elsewhere a background thread fills a bounded queue.
+    # Batches arrive already on `device`, so the x.to(device) calls in the
+    # train/validate functions become no-ops.
+    def __init__(self, data_loader, device, queue_size=2):
+        self.data_loader = data_loader
+        self.device = torch.device(device)
+        self.queue_size = queue_size
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        if self.device.type == "cuda":
+            return self.iter_stream()
+        return self.iter_thread()
+
+    def to_device(self, batch, non_blocking=False):
+        if isinstance(batch, (tuple, list)):
+            return type(batch)(self.to_device(b, non_blocking) for b in batch)
+        if non_blocking and batch.device.type == "cpu" and not batch.is_pinned():
+            batch = batch.pin_memory()
+        return batch.to(self.device, non_blocking=non_blocking)
+
+    def iter_stream(self):
+        stream = torch.cuda.Stream(self.device)
+        iterator = iter(self.data_loader)
+
+        def stage():
+            batch = next(iterator, None)
+            if batch is None:
+                return None
+            with torch.cuda.stream(stream):
+                return self.to_device(batch, non_blocking=True)
+
+        next_batch = stage()
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            batch = next_batch
+            # keep the side-stream allocations alive until compute is done
+            for tensor in batch if isinstance(batch, (tuple, list)) else (batch,):
+                tensor.record_stream(current_stream)
+            next_batch = stage()
+            yield batch
+
+    def iter_thread(self):
+        batches = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            try:
+                for batch in self.data_loader:
+                    if not put(self.to_device(batch)):
+                        return
+            except Exception as error:
+                put(error)
+            put(done)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is done:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+            producer.join()
+
+
+class MetricAccumulator:
+    # With on_device=True the running loss stays a device tensor and is only
+    # read back in compute(), so the loop never waits on .item().
+    def __init__(self, device, on_device=False):
+        self.on_device = on_device
+        self.n_batches = 0
+        self.loss_sum = torch.zeros((), device=device) if on_device else 0.0
+
+    def update(self, loss):
+        loss = loss.detach()
+        self.loss_sum += loss if self.on_device else loss.item()
+        self.n_batches += 1
+
+    def compute(self):
+        loss_sum = self.loss_sum.item() if self.on_device else self.loss_sum
+        return loss_sum / self.n_batches
+
+
+class StreamingRegressionMetrics:
+    # O(1)-state regression metrics: running sums for MAE/MSE, a Welford /
+    # Chan merge of the target mean and M2 for R^2, and a log-bucketed
+    # (DDSketch-style) histogram of absolute errors for quantiles. Each
+    # quantile is within relative_accuracy of the exact value for errors in
+    # [min_error, max_error]; smaller errors land in the first bucket.
+    def __init__(
+        self,
+        device,
+        quantiles=(0.5, 0.9, 0.99),
+        relative_accuracy=0.01,
+        min_error=1e-9,
+        max_error=1e9,
+    ):
+        self.quantiles = quantiles
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.min_index = math.floor(math.log(min_error) / self.log_gamma)
+        n_buckets = math.ceil(math.log(max_error) / self.log_gamma) - self.min_index
+        self.buckets = torch.zeros(n_buckets + 1, dtype=torch.long, device=device)
+
+        self.n_samples = 0
+        self.abs_error_sum = torch.zeros((), dtype=torch.float64, device=device)
+        self.sq_error_sum = torch.zeros((), dtype=torch.float64, device=device)
+        self.y_mean = torch.zeros((), dtype=torch.float64, device=device)
+        self.y_m2 = torch.zeros((), dtype=torch.float64, device=device)
+
+    def update(self, y_hat, y):
+        y = y.reshape(y_hat.shape).double().flatten()
+        error = y_hat.double().flatten() - y
+        abs_error = error.abs()
+        self.abs_error_sum += abs_error.sum()
+        self.sq_error_sum += (error**2).sum()
+
+        n_batch = y.numel()
+        n_total = self.n_samples + n_batch
+        batch_mean = y.mean()
+        delta = batch_mean - self.y_mean
+        self.y_mean += delta * n_batch / n_total
+        self.y_m2 += ((y - batch_mean) ** 2).sum()
+        self.y_m2 += delta**2 * self.n_samples * n_batch / n_total
+        self.n_samples = n_total
+
+        index = torch.ceil(torch.log(abs_error) / self.log_gamma) - self.min_index
+        index = index.nan_to_num(0.0).clamp_(0, len(self.buckets) - 1).long()
+        self.buckets += torch.bincount(index, minlength=len(self.buckets))
+
+    def compute(self):
+        mse = self.sq_error_sum.item() / self.n_samples
+        cumulative = self.buckets.cumsum(0).cpu()
+        error_quantiles = {}
+        for q in self.quantiles:
+            rank = max(1, math.ceil(q * self.n_samples))
+            bucket = int(torch.searchsorted(cumulative, rank))
+            upper = self.gamma ** (bucket + self.min_index)
+            error_quantiles[q] = 2 * upper / (self.gamma + 1)
+        return {
+            "n_samples": self.n_samples,
+            "mae": self.abs_error_sum.item() / self.n_samples,
+            "mse": mse,
+            "rmse": math.sqrt(mse),
+            "r2": 1.0 - self.sq_error_sum.item() / self.y_m2.item(),
+            "error_quantiles": error_quantiles,
+        }
+
+
+def fold_batchnorm(model):
+    # NeuralNetwork applies bn after relu, so bn cannot fold into the Linear
+    # before it; it folds into the next one instead: W(a*h + b) + c.
+    folded = deepcopy(model).eval()
+    folded.fused = False  # fused_forward reads the bn modules replaced below
+    for bn_name, fc_name in (("bn1", "fc2"), ("bn2", "fc3"), ("bn3", "fc4")):
+        bn = getattr(folded, bn_name)
+        fc = getattr(folded, fc_name)
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        shift = bn.bias - bn.running_mean * scale
+        with torch.no_grad():
+            fc.bias.add_(fc.weight @ shift)
+            fc.weight.mul_(scale)
+        setattr(folded, bn_name, nn.Identity())
+    return folded
+
+
+class InferenceEngine:
+    # Wraps a model for repeated eval-only use: BatchNorm is folded away and
+    # the forward is compiled once, then reused across predict_*_fast calls.
+    def __init__(self, model, device, backend="inductor"):
+        model = model.to(device).eval()
+        if isinstance(model, NeuralNetwork):
+            model = fold_batchnorm(model)
+        self.model = model
+        self.device = device
+        self.compiled = torch.compile(model, backend=backend, dynamic=True)
+
+    def __call__(self, x):
+        return self.compiled(x)
+
+
+class PhaseProfiler:
+    # Opt-in per-phase wall/CPU timers for the train/validate functions.
+    # Device work is synchronised at phase boundaries so asynchronous CUDA
+    # time is charged to the phase that issued it. With trace_path set, each
+    # epoch is also recorded with torch.profiler and exported as a Chrome
+    # trace to f"{trace_path}_epoch{n}.json".
+    def __init__(self, device, trace_path=None, enabled=True):
+        self.device = torch.device(device)
+        self.trace_path = trace_path
+        self.enabled = enabled
+        self.n_epochs = 0
+        self.reset()
+
+    def reset(self):
+        self.wall = defaultdict(float)
+        self.cpu = defaultdict(float)
+        self.n_samples = 0
+        self.epoch_wall = 0.0
+        self.peak_memory_mb = None
+
+    def synchronize(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        self.synchronize()
+        wall, cpu = time.perf_counter(), time.process_time()
+        yield
+        self.synchronize()
+        self.wall[name] += time.perf_counter() - wall
+        self.cpu[name] += time.process_time() - cpu
+
+    def iterate(self, data_loader):
+        # times fetching each batch from the loader as the "load" phase
+        iterator = iter(data_loader)
+        while True:
+            with self.phase("load"):
+                batch = next(iterator, None)
+            if batch is None:
+                return
+            yield batch
+
+    def count(self, n_samples):
+        self.n_samples += n_samples
+
+    @contextmanager
+    def epoch(self):
+        if not self.enabled:
+            yield
+            return
+        self.reset()
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+        trace = None
+        if self.trace_path is not None:
+            trace = torch.profiler.profile(record_shapes=True)
+            trace.__enter__()
+        start = time.perf_counter()
+        yield
+        self.synchronize()
+        self.epoch_wall = time.perf_counter() - start
+        if trace is not None:
+            trace.__exit__(None, None, None)
+            trace.export_chrome_trace(f"{self.trace_path}_epoch{self.n_epochs}.json")
+        if self.device.type == "cuda":
+            self.peak_memory_mb = torch.cuda.max_memory_allocated(self.device) / 2**20
+        else:
+            # process-wide high-water mark, not reset between epochs
+            self.peak_memory_mb = (
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            )
+        self.n_epochs += 1
+
+    def summary(self):
+        # None when disabled, so callers still get a fixed-length result
+        if not self.enabled:
+            return None
+        return {
+            "wall": dict(self.wall),
+            "cpu": dict(self.cpu),
+            "epoch_wall": self.epoch_wall,
+            "samples_per_sec": (
+                self.n_samples / self.epoch_wall if self.epoch_wall else 0.0
+            ),
+            "peak_memory_mb": self.peak_memory_mb,
+        }
+
+
+class Lamb(optim.Optimizer):
+    # Adam with a per-tensor trust ratio ||w|| / ||update|| (You et al., LAMB),
+    # which keeps large-batch training stable at scaled-up learning rates.
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-6, weight_decay=0.0):
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
+        super(Lamb, self).__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
 
-    for x_train, y_train in data_loader:
-        x_train, y_train = x_train.to(device), y_train.to(device)
+        for group in self.param_groups:
+            beta1, beta2 = group["betas"]
+            for p in group["params"]:
+                if p.grad is None:
+                    continue
+                state = self.state[p]
+                if not state:
+                    state["step"] = 0
+                    state["exp_avg"] = torch.zeros_like(p)
+                    state["exp_avg_sq"] = torch.zeros_like(p)
+                state["step"] += 1
+                exp_avg, exp_avg_sq = state["exp_avg"], state["exp_avg_sq"]
+                exp_avg.mul_(beta1).add_(p.grad, alpha=1 - beta1)
+                exp_avg_sq.mul_(beta2).addcmul_(p.grad, p.grad, value=1 - beta2)
 
-        optimizer.zero_grad()
+                m_hat = exp_avg / (1 - beta1 ** state["step"])
+                v_hat = exp_avg_sq / (1 - beta2 ** state["step"])
+                update = m_hat / (v_hat.sqrt() + group["eps"])
+                if group["weight_decay"]:
+                    update.add_(p, alpha=group["weight_decay"])
 
-        y_hat = model(x_train)
-        loss = criterion(y_hat, y_train)
+                weight_norm = p.norm()
+                update_norm = update.norm()
+                trust_ratio = torch.where(
+                    (weight_norm > 0) & (update_norm > 0),
+                    weight_norm / update_norm,
+                    torch.ones_like(weight_norm),
+                )
+                p.add_(update * trust_ratio, alpha=-group["lr"])
+
+        return loss
+
+
+def make_large_batch_optimizer(
+    model, effective_batch_size, base_lr=0.001, base_batch_size=64, weight_decay=0.1
+):
+    # linear learning-rate scaling from the batch size the base_lr was tuned
+    # for; biases and BatchNorm parameters are excluded from weight decay
+    decay = [p for p in model.parameters() if p.ndim > 1]
+    no_decay = [p for p in model.parameters() if p.ndim <= 1]
+    lr = base_lr * effective_batch_size / base_batch_size
+    return Lamb(
+        [
+            {"params": decay, "weight_decay": weight_decay},
+            {"params": no_decay, "weight_decay": 0.0},
+        ],
+        lr=lr,
+    )
+
+
+class CombinedOptimizer:
+    # Steps several optimizers as one, e.g. Adam for the dense parameters and
+    # SparseAdam for a sparse EmbeddingBag. Build schedulers per entry of
+    # self.optimizers.
+    def __init__(self, optimizers):
+        self.optimizers = optimizers
+
+    def zero_grad(self, set_to_none=True):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad(set_to_none=set_to_none)
+
+    def step(self):
+        for optimizer in self.optimizers:
+            optimizer.step()
+
+    def state_dict(self):
+        return [optimizer.state_dict() for optimizer in self.optimizers]
+
+    def load_state_dict(self, state_dicts):
+        for optimizer, state_dict in zip(self.optimizers, state_dicts):
+            optimizer.load_state_dict(state_dict)
+
+
+def make_mixed_optimizer(model, lr=0.001, weight_decay=0.1):
+    if model.embedding is None or not model.embedding.sparse:
+        return optim.Adam(model.parameters(), lr=lr, weight_decay=weight_decay)
+    embedding = {id(p) for p in model.embedding.parameters()}
+    dense = [p for p in model.parameters() if id(p) not in embedding]
+    # SparseAdam has no weight decay; only the touched rows are updated
+    return CombinedOptimizer(
+        [
+            optim.Adam(dense, lr=lr, weight_decay=weight_decay),
+            optim.SparseAdam(list(model.embedding.parameters()), lr=lr),
+        ]
+    )
+
+
+def copy_to_cpu(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: copy_to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(copy_to_cpu(value) for value in obj)
+    return deepcopy(obj)
+
+
+class CheckpointManager:
+    # Saves model/optimizer/scheduler/EarlyStopper/RNG state every
+    # `every_n_epochs`. The training loop only pays for a CPU snapshot; the
+    # torch.save runs on a background thread, writes to a temporary file and
+    # is renamed into place, so a crash never leaves a partial checkpoint.
+    # Only the newest `keep_last` checkpoints are kept.
+    def __init__(self, directory, keep_last=3, every_n_epochs=1, async_save=True):
+        self.directory = directory
+        self.keep_last = keep_last
+        self.every_n_epochs = every_n_epochs
+        self.async_save = async_save
+        self.executor = ThreadPoolExecutor(max_workers=1) if async_save else None
+        self.pending = None
+        os.makedirs(directory, exist_ok=True)
+
+    def save(
+        self, epoch, model, optimizer, scheduler, early_stopper=None, history=None
+    ):
+        if (epoch + 1) % self.every_n_epochs:
+            return
+        # at most one write in flight, so snapshots never pile up in memory
+        self.wait()
+        state = {
+            "epoch": epoch,
+            "model": copy_to_cpu(model.state_dict()),
+            "optimizer": copy_to_cpu(optimizer.state_dict()),
+            "scheduler": scheduler.state_dict() if scheduler is not None else None,
+            "early_stopper": None,
+            "history": deepcopy(history),
+            "rng": {
+                "torch": torch.get_rng_state(),
+                "cuda": (
+                    torch.cuda.get_rng_state_all()
+                    if torch.cuda.is_available()
+                    else None
+                ),
+                "numpy": np.random.get_state(),
+                "python": random.getstate(),
+            },
+        }
+        if early_stopper is not None:
+            state["early_stopper"] = {
+                "best_loss": early_stopper.best_loss,
+                "counter": early_stopper.counter,
+                "best_model_weights": copy_to_cpu(early_stopper.best_model_weights),
+            }
+
+        path = os.path.join(self.directory, f"checkpoint_epoch{epoch:05d}.pt")
+        if self.async_save:
+            self.pending = self.executor.submit(self.write, state, path)
+        else:
+            self.write(state, path)
+
+    def write(self, state, path):
+        tmp_path = path + ".tmp"
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)
+        for old_path in CheckpointManager.list_checkpoints(self.directory)[
+            : -self.keep_last
+        ]:
+            os.remove(old_path)
+
+    def wait(self):
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    @staticmethod
+    def list_checkpoints(directory):
+        names = sorted(
+            name
+            for name in os.listdir(directory)
+            if name.startswith("checkpoint_epoch") and name.endswith(".pt")
+        )
+        return [os.path.join(directory, name) for name in names]
+
+
+def load_checkpoint(path, model, optimizer, scheduler=None, early_stopper=None):
+    # path may be a checkpoint file or a CheckpointManager directory, in which
+    # case the newest checkpoint is used. Returns (next_epoch, history).
+    if os.path.isdir(path):
+        checkpoints = CheckpointManager.list_checkpoints(path)
+        if not checkpoints:
+            raise FileNotFoundError(f"No checkpoints in {path}")
+        path = checkpoints[-1]
+    state = torch.load(path, weights_only=False)
+
+    model.load_state_dict(state["model"])
+    optimizer.load_state_dict(state["optimizer"])
+    if scheduler is not None and state["scheduler"] is not None:
+        scheduler.load_state_dict(state["scheduler"])
+    if early_stopper is not None and state["early_stopper"] is not None:
+        early_stopper.best_loss = state["early_stopper"]["best_loss"]
+        early_stopper.counter = state["early_stopper"]["counter"]
+        weights = state["early_stopper"]["best_model_weights"]
+        if early_stopper.snapshot == "deepcopy" or weights is None:
+            early_stopper.best_model_weights = weights
+        else:
+            early_stopper.best_model_weights = early_stopper.allocate_snapshot(
+                model.state_dict()
+            )
+            for name, tensor in weights.items():
+                early_stopper.best_model_weights[name].copy_(tensor)
+
+    torch.set_rng_state(state["rng"]["torch"])
+    if state["rng"]["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["rng"]["cuda"])
+    np.random.set_state(state["rng"]["numpy"])
+    random.setstate(state["rng"]["python"])
+    return state["epoch"] + 1, state["history"]
+
+
+def benchmark_checkpoint_stall(
+    model, optimizer, directory, n_saves=5, epoch_seconds=1.0
+):
+    # Time the training loop is blocked per checkpoint; epoch_seconds of
+    # sleep between saves stands in for an epoch of training.
+    results = {}
+    for async_save in (False, True):
+        checkpoints = CheckpointManager(directory, async_save=async_save)
+        stalls = []
+        for epoch in range(n_saves):
+            time.sleep(epoch_seconds)
+            start = time.perf_counter()
+            checkpoints.save(epoch, model, optimizer, None)
+            stalls.append(time.perf_counter() - start)
+        checkpoints.wait()
+        name = "async" if async_save else "torch.save"
+        results[name] = sum(stalls) / n_saves
+        print(f"{name}: {results[name] * 1000:.1f} ms stall per checkpoint")
+    return results
+
+
+class QuantizedWrapper(nn.Module):
+    # QuantStub/DeQuantStub around a float model for eager-mode static int8;
+    # inputs and outputs stay float so predict_* can use it unchanged
+    def __init__(self, model):
+        super(QuantizedWrapper, self).__init__()
+        self.quant = QuantStub()
+        self.model = model
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.model(self.quant(x)))
+
+
+def quantize_dynamic_int8(model):
+    # int8 weights for every Linear, activations quantised on the fly
+    model = deepcopy(model).to("cpu").eval()
+    if isinstance(model, NeuralNetwork):
+        model = fold_batchnorm(model)
+    return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def quantize_static_int8(model, calibration_loader, n_batches=32, backend="x86"):
+    # int8 weights and activations for the conv and Linear layers, with
+    # activation ranges observed over n_batches of calibration_loader
+    torch.backends.quantized.engine = backend
+    wrapped = QuantizedWrapper(deepcopy(model).to("cpu").eval()).eval()
+    wrapped.qconfig = get_default_qconfig(backend)
+    prepared = prepare(wrapped)
+    with torch.no_grad():
+        for batch_index, batch in enumerate(calibration_loader):
+            if batch_index >= n_batches:
+                break
+            x = batch[0] if isinstance(batch, (tuple, list)) else batch
+            prepared(x.to("cpu"))
+    return convert(prepared)
+
+
+def autocast(device, amp_dtype=None):
+    # amp_dtype=None keeps fp32; torch.bfloat16 works on CPU and GPU,
+    # torch.float16 should be paired with a GradScaler from make_grad_scaler.
+    return torch.autocast(
+        device_type=torch.device(device).type,
+        dtype=amp_dtype,
+        enabled=amp_dtype is not None,
+    )
+
+
+def make_grad_scaler(device, amp_dtype=None):
+    device_type = torch.device(device).type
+    enabled = amp_dtype == torch.float16 and device_type == "cuda"
+    return torch.amp.GradScaler(device_type, enabled=enabled)
+
+
+def scaled_backward(loss, scaler=None):
+    if scaler is None:
         loss.backward()
+    else:
+        scaler.scale(loss).backward()
 
+
+def optimizer_step(optimizer, scaler=None):
+    if scaler is None:
         optimizer.step()
+    else:
+        scaler.step(optimizer)
+        scaler.update()
+
+
+def check_amp_parity(
+    model, data_loader, criterion, device, amp_dtype=torch.bfloat16, rtol=0.02
+):
+    # Validation loss must match fp32 within rtol.
+    fp32_loss = validate_regression(model, data_loader, criterion, device)
+    amp_loss = validate_regression(
+        model, data_loader, criterion, device, amp_dtype=amp_dtype
+    )
+    print(f"fp32: loss {fp32_loss:.5f}")
+    print(f"{amp_dtype}: loss {amp_loss:.5f}")
+    return abs(amp_loss - fp32_loss) <= rtol * abs(fp32_loss)
+
+
+def benchmark_early_stopper(
+    snapshots=("deepcopy", "inplace", "mmap"),
+    n_layers=6,
+    width=4096,
+    n_improvements=5,
+    mmap_path="early_stopper_snapshot.bin",
+):
+    # Each mode runs in a forked process so ru_maxrss is a clean peak per mode.
+    # The default model is ~400 MB of fp32 weights.
+    def run(snapshot, queue):
+        model = nn.Sequential(*[nn.Linear(width, width) for _ in range(n_layers)])
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        early_stopper = EarlyStopper(snapshot=snapshot, mmap_path=mmap_path)
+        start = time.perf_counter()
+        for improvement in range(n_improvements):
+            early_stopper.early_stop(1.0 / (improvement + 1), model)
+        elapsed = (time.perf_counter() - start) / n_improvements
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        queue.put((elapsed, (peak - baseline) / 1024))
 
-        batch_loss.append(loss.item())
+    context = mp.get_context("fork")
+    results = {}
+    for snapshot in snapshots:
+        queue = context.Queue()
+        process = context.Process(target=run, args=(snapshot, queue))
+        process.start()
+        results[snapshot] = queue.get()
+        process.join()
+        print(
+            f"{snapshot}: {results[snapshot][0] * 1000:.1f} ms per improvement, "
+            f"peak RSS +{results[snapshot][1]:.0f} MB"
+        )
+    if os.path.exists(mmap_path):
+        os.remove(mmap_path)
+    return results
+
+
+def benchmark_fused_mlp(
+    input_dim=64, hidden_dim=64, batch_sizes=(64, 512, 2048, 8192), n_iters=50
+):
+    # eval forward only: fused=True does not change the training path
+    results = {}
+    for batch_size in batch_sizes:
+        x = torch.randn(batch_size, input_dim)
+        timings = {}
+        for fused in (False, True):
+            torch.manual_seed(0)
+            model = NeuralNetwork(input_dim, hidden_dim, fused=fused).eval()
+            with torch.no_grad():
+                model(x)  # warm-up
+                start = time.perf_counter()
+                for _ in range(n_iters):
+                    model(x)
+                timings[fused] = (time.perf_counter() - start) / n_iters
+
+        results[batch_size] = timings
+        eager, fused = timings[False], timings[True]
+        print(
+            f"batch {batch_size}: eval forward {eager * 1e3:.3f} -> "
+            f"{fused * 1e3:.3f} ms ({eager / fused:.2f}x)"
+        )
+    return results
+
+def benchmark_loaders(x, y, batch_size=64, n_epochs=3):
+    loaders = {
+        "DataLoader": DataLoader(
+            CustomDataset(x, y), batch_size=batch_size, shuffle=True
+        ),
+        "TensorBatchLoader": TensorBatchLoader(
+            x, y, batch_size=batch_size, shuffle=True
+        ),
+    }
+    results = {}
+    for name, loader in loaders.items():
+        n_batches = 0
+        start = time.perf_counter()
+        for _ in range(n_epochs):
+            for x_batch, y_batch in loader:
+                n_batches += 1
+        if x.is_cuda:
+            torch.cuda.synchronize()
+        results[name] = n_batches / (time.perf_counter() - start)
+        print(f"{name}: {results[name]:.1f} batches/sec")
+    return results
+
+
+def train_regression(
+    model,
+    data_loader,
+    optimizer,
+    criterion,
+    device,
+    on_device_metrics=False,
+    amp_dtype=None,
+    scaler=None,
+    profiler=None,
+    accumulation_steps=1,
+):
+    # accumulation_steps > 1 sums gradients over that many micro-batches
+    # before each optimizer step; a trailing partial group is stepped too
+    model.to(device).train()
+    metrics = MetricAccumulator(device, on_device=on_device_metrics)
+    optimizer.zero_grad()
+    pending = 0
+
+    if profiler is None and amp_dtype is None:
+        # plain loop, no per-batch phase timers or autocast contexts
+        for x_train, y_train in data_loader:
+            x_train, y_train = x_train.to(device), y_train.to(device)
+            y_hat = model(x_train)
+            loss = criterion(y_hat.float(), y_train)
+            scaled_backward(loss / accumulation_steps, scaler)
+            pending += 1
+            if pending == accumulation_steps:
+                optimizer_step(optimizer, scaler)
+                optimizer.zero_grad()
+                pending = 0
+            metrics.update(loss)
+        if pending:
+            optimizer_step(optimizer, scaler)
+            optimizer.zero_grad()
+        return metrics.compute()
+
+    timer = profiler if profiler is not None else PhaseProfiler(device, enabled=False)
+    with timer.epoch():
+        for x_train, y_train in timer.iterate(data_loader):
+            with timer.phase("data"):
+                x_train, y_train = x_train.to(device), y_train.to(device)
+
+            with timer.phase("forward"), autocast(device, amp_dtype):
+                y_hat = model(x_train)
+                loss = criterion(y_hat.float(), y_train)
+
+            with timer.phase("backward"):
+                scaled_backward(loss / accumulation_steps, scaler)
+            pending += 1
 
-    loss_total = sum(batch_loss) / len(batch_loss)
+            if pending == accumulation_steps:
+                with timer.phase("optimizer"):
+                    optimizer_step(optimizer, scaler)
+                    optimizer.zero_grad()
+                pending = 0
 
+            with timer.phase("metrics"):
+                metrics.update(loss)
+            timer.count(y_train.size(0))
+
+        if pending:
+            with timer.phase("optimizer"):
+                optimizer_step(optimizer, scaler)
+                optimizer.zero_grad()
+
+        with timer.phase("metrics"):
+            loss_total = metrics.compute()
+
+    if profiler is not None:
+        return loss_total, profiler.summary()
     return loss_total
 
 
-def validate_regression(model, data_loader, criterion, device):
+def validate_regression(
+    model,
+    data_loader,
+    criterion,
+    device,
+    on_device_metrics=False,
+    amp_dtype=None,
+    profiler=None,
+):
     model.to(device).eval()
-    batch_loss = []
+    metrics = MetricAccumulator(device, on_device=on_device_metrics)
 
-    with torch.no_grad():
-        for x, y in data_loader:
-            x, y = x.to(device), y.to(device)
-            y_hat = model(x)
-            loss = criterion(y_hat, y)
-            batch_loss.append(loss.item())
-    loss_total = sum(batch_loss) / len(batch_loss)
+    if profiler is None and amp_dtype is None:
+        with torch.no_grad():
+            for x, y in data_loader:
+                x, y = x.to(device), y.to(device)
+                y_hat = model(x)
+                loss = criterion(y_hat.float(), y)
+                metrics.update(loss)
+        return metrics.compute()
 
+    timer = profiler if profiler is not None else PhaseProfiler(device, enabled=False)
+    with timer.epoch(), torch.no_grad(), autocast(device, amp_dtype):
+        for x, y in timer.iterate(data_loader):
+            with timer.phase("data"):
+                x, y = x.to(device), y.to(device)
+            with timer.phase("forward"):
+                y_hat = model(x)
+                loss = criterion(y_hat.float(), y)
+            with timer.phase("metrics"):
+                metrics.update(loss)
+            timer.count(y.size(0))
+        with timer.phase("metrics"):
+            loss_total = metrics.compute()
+
+    if profiler is not None:
+        return loss_total, profiler.summary()
     return loss_total
 
 
+def fit_regression(
+    model,
+    train_loader,
+    val_loader,
+    optimizer,
+    scheduler,
+    criterion,
+    device,
+    n_epochs,
+    early_stopper=None,
+    checkpoints=None,
+    resume_from=None,
+):
+    start_epoch = 0
+    history = {"train_loss": [], "val_loss": []}
+    if resume_from is not None:
+        start_epoch, history = load_checkpoint(
+            resume_from, model, optimizer, scheduler, early_stopper
+        )
+
+    for epoch in range(start_epoch, n_epochs):
+        set_loader_epoch(train_loader, epoch)
+        history["train_loss"].append(
+            train_regression(model, train_loader, optimizer, criterion, device)
+        )
+        history["val_loss"].append(
+            validate_regression(model, val_loader, criterion, device)
+        )
+        scheduler.step()
+
+        stop = early_stopper is not None and early_stopper.early_stop(
+            history["val_loss"][-1], model
+        )
+        if checkpoints is not None:
+            checkpoints.save(epoch, model, optimizer, scheduler, early_stopper, history)
+        if stop:
+            break
+
+    if checkpoints is not None:
+        checkpoints.wait()
+    if early_stopper is not None:
+        early_stopper.restore_best_weights(model)
+    return history
+
+
 def evaluate_regression(model, data_loader, device):
     model.to(device).eval()
     predictions = []
@@ -170,6 +1588,81 @@ def evaluate_regression(model, data_loader, device):
     return predictions, actuals
 
 
+def evaluate_regression_streaming(
+    model,
+    data_loader,
+    device,
+    quantiles=(0.5, 0.9, 0.99),
+    relative_accuracy=0.01,
+    predictions_path=None,
+    n_samples=None,
+):
+    # With predictions_path, predictions are written batch by batch to a
+    # memory-mapped .npy of n_samples rows (defaults to the dataset length).
+    model.to(device).eval()
+    metrics = StreamingRegressionMetrics(
+        device, quantiles=quantiles, relative_accuracy=relative_accuracy
+    )
+    if predictions_path is not None and n_samples is None:
+        if hasattr(data_loader, "dataset"):
+            n_samples = len(data_loader.dataset)
+        else:
+            n_samples = len(data_loader.tensors[0])
+    predictions = None
+
+    start = 0
+    with torch.no_grad():
+        for x, y in data_loader:
+            x, y = x.to(device), y.to(device)
+            y_hat = model(x)
+            metrics.update(y_hat, y)
+            if predictions_path is not None:
+                if predictions is None:
+                    predictions = np.lib.format.open_memmap(
+                        predictions_path,
+                        mode="w+",
+                        dtype=np.float32,
+                        shape=(n_samples, *y_hat.shape[1:]),
+                    )
+                predictions[start : start + len(y_hat)] = y_hat.float().cpu().numpy()
+                start += len(y_hat)
+
+    if predictions is not None:
+        predictions.flush()
+    return metrics.compute()
+
+
+def quantization_report(fp32_model, quantized_model, data_loader, n_runs=3):
+    device = torch.device("cpu")
+    results = {}
+    outputs = {}
+    for name, model in (("fp32", fp32_model), ("int8", quantized_model)):
+        predictions, actuals = evaluate_regression(model, data_loader, device)
+        outputs[name] = predictions
+        start = time.perf_counter()
+        for _ in range(n_runs):
+            evaluate_regression(model, data_loader, device)
+        elapsed = (time.perf_counter() - start) / n_runs
+        errors = predictions - actuals.reshape(predictions.shape)
+        results[name] = {
+            "mse": float((errors**2).mean()),
+            "ms_per_batch": 1000 * elapsed / len(data_loader),
+            "rows_per_sec": len(actuals) / elapsed,
+        }
+        print(
+            f"{name}: MSE {results[name]['mse']:.5f}, "
+            f"{results[name]['ms_per_batch']:.3f} ms/batch, "
+            f"{results[name]['rows_per_sec']:.0f} rows/sec"
+        )
+    results["mse_delta"] = results["int8"]["mse"] - results["fp32"]["mse"]
+    results["max_abs_diff"] = float(np.abs(outputs["int8"] - outputs["fp32"]).max())
+    print(
+        f"MSE delta: {results['mse_delta']:+.5f}, "
+        f"max |int8 - fp32|: {results['max_abs_diff']:.5f}"
+    )
+    return results
+
+
 def predict_regression(model, data_loader, device):
     model.to(device).eval()
     predictions = []
@@ -180,10 +1673,300 @@ def predict_regression(model, data_loader, device):
             y_hat = model(x_batch)
             predictions.append(y_hat)
 
+    if isinstance(model, NeuralNetworkEnsemble):
+        # (n_members, n_samples, 1) -> mean and variance across members
+        predictions = torch.cat(predictions, dim=1)
+        return (
+            predictions.mean(dim=0).cpu().numpy(),
+            predictions.var(dim=0).cpu().numpy(),
+        )
+
     predictions = torch.cat(predictions, dim=0).cpu().numpy()
     return predictions
 
 
+def predict_regression_fast(model, data_loader, device):
+    if not isinstance(model, InferenceEngine):
+        model = InferenceEngine(model, device)
+    if hasattr(data_loader, "dataset"):
+        n_samples = len(data_loader.dataset)
+    else:
+        n_samples = len(data_loader.tensors[0])
+    predictions = None
+
+    start = 0
+    with torch.inference_mode():
+        for x_batch in data_loader:
+            x_batch = x_batch.to(device)
+            y_hat = model(x_batch)
+            if predictions is None:
+                predictions = torch.empty(
+                    (n_samples, *y_hat.shape[1:]), dtype=y_hat.dtype, device=device
+                )
+            predictions[start : start + len(x_batch)] = y_hat
+            start += len(x_batch)
+
+    predictions = predictions.cpu().numpy()
+    return predictions
+
+
+sweep_worker_data = {}
+
+
+def init_sweep_worker(train_dataset, val_dataset, n_threads):
+    # forked pool workers inherit the datasets instead of unpickling them
+    # for every task
+    sweep_worker_data["train_dataset"] = train_dataset
+    sweep_worker_data["val_dataset"] = val_dataset
+    torch.set_num_threads(n_threads)
+
+
+def run_sweep_trial(config, input_dim, start_epoch, stop_epoch, max_epochs, state):
+    device = torch.device("cpu")
+    torch.manual_seed(config["seed"])
+    model = NeuralNetwork(input_dim, config["hidden_dim"])
+    criterion = nn.MSELoss()
+    optimizer = optim.Adam(
+        model.parameters(),
+        lr=config["lr"],
+        weight_decay=config["weight_decay"],
+    )
+    scheduler = CosineAnnealingLR(optimizer, T_max=max_epochs)
+    early_stopper = EarlyStopper(patience=config["patience"])
+    if state is not None:
+        state = torch.load(io.BytesIO(state))
+        model.load_state_dict(state["model"])
+        optimizer.load_state_dict(state["optimizer"])
+        scheduler.load_state_dict(state["scheduler"])
+        early_stopper.best_loss = state["best_loss"]
+        early_stopper.counter = state["counter"]
+        early_stopper.best_model_weights = state["best_model_weights"]
+
+    train_loader = TensorBatchLoader(
+        sweep_worker_data["train_dataset"],
+        batch_size=config["batch_size"],
+        shuffle=True,
+    )
+    val_loader = TensorBatchLoader(
+        sweep_worker_data["val_dataset"], batch_size=config["batch_size"]
+    )
+
+    early_stopped = False
+    for epoch in range(start_epoch, stop_epoch):
+        train_regression(model, train_loader, optimizer, criterion, device)
+        val_loss = validate_regression(model, val_loader, criterion, device)
+        scheduler.step()
+        if early_stopper.early_stop(val_loss, model):
+            early_stopped = True
+            break
+
+    buffer = io.BytesIO()
+    torch.save(
+        {
+            "model": model.state_dict(),
+            "optimizer": optimizer.state_dict(),
+            "scheduler": scheduler.state_dict(),
+            "best_loss": early_stopper.best_loss,
+            "counter": early_stopper.counter,
+            "best_model_weights": early_stopper.best_model_weights,
+        },
+        buffer,
+    )
+    return early_stopper.best_loss, early_stopped, buffer.getvalue()
+
+
+def run_sweep(
+    train_dataset,
+    val_dataset,
+    input_dim,
+    search_space,
+    n_trials=27,
+    db_path="sweep.sqlite",
+    min_epochs=5,
+    max_epochs=100,
+    reduction_factor=3,
+    max_workers=None,
+    seed=0,
+):
+    # Successive halving: every trial trains to the first rung budget, then
+    # only the best 1 / reduction_factor (by best validation loss) continue
+    # to the next budget. Each finished (trial, rung) is written to SQLite
+    # with its training state, so rerunning with the same db_path resumes.
+    # search_space maps hidden_dim, lr, weight_decay, patience and
+    # batch_size to lists of candidate values. Workers are forked, so call
+    # this from the script or notebook that defines these functions.
+    max_workers = max_workers or os.cpu_count() or 1
+    budgets = []
+    budget = min_epochs
+    while budget < max_epochs:
+        budgets.append(budget)
+        budget *= reduction_factor
+    budgets.append(max_epochs)
+
+    connection = sqlite3.connect(db_path)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS trials (trial_id INTEGER PRIMARY KEY, config TEXT)"
+    )
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS results ("
+        "trial_id INTEGER, rung INTEGER, val_loss REAL, early_stopped INTEGER, "
+        "state BLOB, PRIMARY KEY (trial_id, rung))"
+    )
+    # configs are drawn from a seeded generator, so a resumed sweep
+    # regenerates exactly the same trials
+    generator = np.random.default_rng(seed)
+    for trial_id in range(n_trials):
+        config = {
+            name: values[int(generator.integers(len(values)))]
+            for name, values in search_space.items()
+        }
+        config["seed"] = seed + trial_id
+        connection.execute(
+            "INSERT OR IGNORE INTO trials VALUES (?, ?)",
+            (trial_id, json.dumps(config)),
+        )
+    connection.commit()
+    configs = {
+        trial_id: json.loads(config)
+        for trial_id, config in connection.execute("SELECT * FROM trials")
+    }
+
+    n_threads = max(1, (os.cpu_count() or 1) // max_workers)
+    executor = ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=mp.get_context("fork"),
+        initializer=init_sweep_worker,
+        initargs=(train_dataset, val_dataset, n_threads),
+    )
+    candidates = list(range(n_trials))
+    with executor:
+        for rung, budget in enumerate(budgets):
+            done = {
+                trial_id
+                for (trial_id,) in connection.execute(
+                    "SELECT trial_id FROM results WHERE rung = ?", (rung,)
+                )
+            }
+            futures = {}
+            for trial_id in candidates:
+                if trial_id in done:
+                    continue
+                start_epoch, state, early_stopped = 0, None, False
+                if rung > 0:
+                    val_loss, early_stopped, state = connection.execute(
+                        "SELECT val_loss, early_stopped, state FROM results "
+                        "WHERE trial_id = ? AND rung = ?",
+                        (trial_id, rung - 1),
+                    ).fetchone()
+                    start_epoch = budgets[rung - 1]
+                if early_stopped:
+                    # converged already, carry the result forward untrained
+                    connection.execute(
+                        "INSERT INTO results VALUES (?, ?, ?, ?, ?)",
+                        (trial_id, rung, val_loss, early_stopped, state),
+                    )
+                    continue
+                future = executor.submit(
+                    run_sweep_trial,
+                    configs[trial_id],
+                    input_dim,
+                    start_epoch,
+                    budget,
+                    max_epochs,
+                    state,
+                )
+                futures[future] = trial_id
+
+            for future in as_completed(futures):
+                trial_id = futures[future]
+                val_loss, early_stopped, state = future.result()
+                connection.execute(
+                    "INSERT INTO results VALUES (?, ?, ?, ?, ?)",
+                    (trial_id, rung, val_loss, int(early_stopped), state),
+                )
+                connection.commit()
+                print(
+                    f"Rung {rung} ({budget} epochs), trial {trial_id}: "
+                    f"val loss {val_loss:.5f}"
+                )
+            connection.commit()
+
+            ranked = [
+                trial_id
+                for (trial_id,) in connection.execute(
+                    "SELECT trial_id FROM results WHERE rung = ? ORDER BY val_loss",
+                    (rung,),
+                )
+                if trial_id in candidates
+            ]
+            candidates = ranked[: max(1, len(ranked) // reduction_factor)]
+
+    leaderboard = [
+        (configs[trial_id], val_loss, budgets[rung])
+        for trial_id, rung, val_loss in connection.execute(
+            "SELECT trial_id, MAX(rung), val_loss FROM results "
+            "GROUP BY trial_id ORDER BY MAX(rung) DESC, val_loss"
+        )
+    ]
+    connection.close()
+    return leaderboard
+
+
+def compare_large_batch(
+    train_dataset,
+    val_dataset,
+    input_dim,
+    hidden_dim=64,
+    n_epochs=20,
+    configs=((64, 1, "adam"), (256, 4, "lamb"), (1024, 1, "lamb"), (1024, 4, "lamb")),
+):
+    # configs are (batch_size, accumulation_steps, optimizer) tuples; the
+    # first one is the current setup and the baseline for the speedup
+    device = torch.device("cpu")
+    criterion = nn.MSELoss()
+    results = {}
+    for batch_size, accumulation_steps, optimizer_name in configs:
+        torch.manual_seed(0)
+        model = NeuralNetwork(input_dim, hidden_dim)
+        if optimizer_name == "adam":
+            optimizer = optim.Adam(model.parameters(), lr=0.001, weight_decay=0.1)
+        else:
+            optimizer = make_large_batch_optimizer(
+                model, batch_size * accumulation_steps
+            )
+        train_loader = TensorBatchLoader(
+            train_dataset, batch_size=batch_size, shuffle=True
+        )
+        val_loader = TensorBatchLoader(val_dataset, batch_size=1024)
+
+        start = time.perf_counter()
+        for epoch in range(n_epochs):
+            train_regression(
+                model,
+                train_loader,
+                optimizer,
+                criterion,
+                device,
+                accumulation_steps=accumulation_steps,
+            )
+        elapsed = time.perf_counter() - start
+        val_loss = validate_regression(model, val_loader, criterion, device)
+
+        key = (batch_size, accumulation_steps, optimizer_name)
+        results[key] = {
+            "val_loss": val_loss,
+            "samples_per_sec": len(train_dataset) * n_epochs / elapsed,
+            "steps_per_epoch": -(-len(train_loader) // accumulation_steps),
+        }
+        print(
+            f"batch {batch_size} x {accumulation_steps} ({optimizer_name}): "
+            f"val loss {val_loss:.5f}, "
+            f"{results[key]['samples_per_sec']:.0f} samples/sec, "
+            f"{results[key]['steps_per_epoch']} steps/epoch"
+        )
+    return results
+
+
 # Convert data to PyTorch tensors
 x_train_tensor = torch.tensor(
     x_train.values,
@@ -213,8 +1996,9 @@ y_val_tensor = torch.tensor(
 # Define PyTorch DataLoader for training
 train_dataset = CustomDataset(x_train_tensor, y_train_tensor)
 val_dataset = CustomDataset(x_val_tensor, y_val_tensor)
-train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
-val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False)
+# tensors are already on `device`, so slice whole batches instead of collating
+train_loader = TensorBatchLoader(train_dataset, batch_size=batch_size, shuffle=True)
+val_loader = TensorBatchLoader(val_dataset, batch_size=batch_size, shuffle=False)
 
 # Model Initialization
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")